@@ -20,17 +20,22 @@ import fcntl
 import json
 import os
 import pty
-import pwd
-import shutil
 import socket
 import subprocess
 import termios
 import threading
 
+# subprocess (and therefore threading) is needed for every session, so it's
+# cheapest to import it up front: importing it from the first session thread
+# instead costs an extra malloc arena in the agent.  pwd and shutil are only
+# needed for some sessions, so those get imported on demand.
+
 
 def recv_fds(sock, bufsize, maxfds, flags=0):
     fds = array.array("i")
-    msg, ancdata, flags, addr = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    # CLOEXEC, so that we can safely start agents with close_fds=False
+    msg, ancdata, flags, addr = sock.recvmsg(bufsize, socket.CMSG_LEN(maxfds * fds.itemsize),
+                                             flags | socket.MSG_CMSG_CLOEXEC)
     for cmsg_level, cmsg_type, cmsg_data in ancdata:
         if (cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS):
             fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
@@ -47,36 +52,172 @@ class Session(threading.Thread):
         self.connection = connection
 
     def run(self):
-        msg, fds, _flags, _addr = recv_fds(self.connection, 10000, 1)
-        message = json.loads(msg)
+        fds = []
+        try:
+            msg, fds, _flags, _addr = recv_fds(self.connection, 10000, 3)
+            message = json.loads(msg)
+            if message.get('stats'):
+                self.reply(stats())
+            elif message.get('listen'):
+                self.reply(listen(message['listen']))
+            else:
+                self.reply(self.spawn(message, fds))
+        finally:
+            self.connection.close()
+            for fd in fds:
+                os.close(fd)
+
+    def reply(self, value):
+        try:
+            self.connection.send(json.dumps(value).encode('utf-8'))
+        except BrokenPipeError:
+            pass  # nobody's waiting for it
+
+    def spawn(self, message, fds):
+        """Runs the requested command, returning its exit status or an error"""
         args = message.get('args')
-        env = message.get('env')
+        env = message.get('env') or {}
         cwd = message.get('cwd')
+        # which of stdin/stdout/stderr the fds are for: by default, stdin
+        stdio = dict(zip(message.get('stdio', [0]), fds))
+        use_pty = message.get('pty', True)
+
+        # For restored sessions, whose directory might not exist anymore
+        if cwd and message.get('cwd_fallback') and not os.path.isdir(cwd):
+            cwd = os.path.expanduser('~')
 
         if not args:
+            import pwd
             try:
                 args = [pwd.getpwuid(os.getuid()).pw_shell]
             except (OSError, KeyError):
                 args = ['/bin/sh']
         elif args[0] == '_PAGER':
+            import shutil
             args[0] = shutil.which('nvim') or shutil.which('vim') or shutil.which('less') or 'more'
         elif args[0] == '_EDITOR':
+            import shutil
             args[0] = os.environ.get('EDITOR') or shutil.which('nvim') or shutil.which('vim') or 'vi'
 
-        theirs, ours = pty.openpty()
-        send_fds(self.connection, [b'"pty"'], [theirs])
-        os.close(theirs)
+        ours = child = None
+        try:
+            if use_pty:
+                theirs, ours = pty.openpty()
+                send_fds(self.connection, [b'"pty"'], [theirs])
+                os.close(theirs)
+
+            # The pty becomes the controlling terminal, via the first stdio fd
+            # that it's connected to (if any).
+            tty_fd = next((fd for fd in range(3) if fd not in stdio), None) if use_pty else None
+
+            # For 'agent' sessions, args is another agent (in a container, say).
+            # We give it its fd 3 and send the other end back to the client, who
+            # then talks to the new agent directly.
+            if message.get('agent'):
+                listener, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                send_fds(self.connection, [b'"agent"'], [listener.fileno()])
+                listener.close()
+                agent_fd = child.fileno()
+            else:
+                agent_fd = None
+
+            def setup_child():
+                if tty_fd is not None:
+                    fcntl.ioctl(tty_fd, termios.TIOCSCTTY, 0)
+                if agent_fd == 3:
+                    os.set_inheritable(agent_fd, True)
+                elif agent_fd is not None:
+                    os.dup2(agent_fd, 3)
+
+            default = ours if use_pty else subprocess.DEVNULL
+            needs_setup = tty_fd is not None or agent_fd is not None
+            try:
+                result = subprocess.run(args, env=dict(os.environ, **env), cwd=cwd,
+                                        check=False, start_new_session=True, close_fds=agent_fd is None,
+                                        stdin=stdio.get(0, default), stdout=stdio.get(1, default),
+                                        stderr=stdio.get(2, default),
+                                        preexec_fn=setup_child if needs_setup else None)
+            except OSError as exc:
+                # Missing command or cwd, usually.  Tell the user on the pty,
+                # if there is one, and the client in any case.
+                error = f'{exc.filename or args[0]}: {exc.strerror}'
+                if ours is not None:
+                    os.write(ours, f'boxi: {error}\r\n'.encode('utf-8'))
+                return {'error': exc.errno, 'message': error}
+
+            return result.returncode
+        finally:
+            if child is not None:
+                child.close()
+            if ours is not None:
+                os.close(ours)
+
+
+def stats():
+    with open('/proc/self/status', encoding='ascii') as status:
+        fields = dict(line.split(':', 1) for line in status)
+    return {
+        'pid': os.getpid(),
+        'rss': int(fields['VmRSS'].split()[0]) * 1024,
+        # ...not counting the session that's asking
+        'threads': threading.active_count() - 1,
+        'sessions': sum(isinstance(thread, Session) for thread in threading.enumerate()) - 1,
+    }
 
-        result = subprocess.run(args, env=dict(os.environ, **env), cwd=cwd,
-                                check=False, start_new_session=True,
-                                stdin=fds[0] if fds else ours, stdout=ours, stderr=ours,
-                                preexec_fn=lambda: fcntl.ioctl(1, termios.TIOCSCTTY, 0))
 
-        self.connection.send(json.dumps(result.returncode).encode('ascii'))
-        self.connection.close()
-        os.close(ours)
-        for fd in fds:
-            os.close(fd)
+class Listener(threading.Thread):
+    """Receives connections for new sessions from one client
+
+    There's usually just one, on fd 3, but a host agent can also serve other
+    Boxi instances (see listen()), and stays around until they're all gone.
+    """
+    active = 0
+    changed = threading.Condition()
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        with Listener.changed:
+            Listener.active += 1
+
+    def run(self):
+        while True:
+            connection = accept(self.sock)
+            if connection is None:
+                break
+            Session(connection).start()
+
+        self.sock.close()
+        with Listener.changed:
+            Listener.active -= 1
+            Listener.changed.notify_all()
+
+    @staticmethod
+    def wait_all():
+        with Listener.changed:
+            Listener.changed.wait_for(lambda: Listener.active == 0)
+
+
+def listen(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        server.bind(path)
+        server.listen()
+    except OSError as exc:
+        server.close()
+        return str(exc)
+
+    def serve():
+        while True:
+            connection, _addr = server.accept()
+            Listener(connection).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return True
 
 
 def socket_from_fd(fd):
@@ -113,13 +254,8 @@ def daemon():
 def main():
     daemon()
 
-    listener = socket_from_fd(3)
-
-    while True:
-        connection = accept(listener)
-        if connection is None:
-            break
-        Session(connection).start()
+    Listener(socket_from_fd(3)).run()
+    Listener.wait_all()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+# Boxi - Terminal emulator for use with Toolbox
+#
+# Copyright (C) 2022 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# This is sent to the agent's interpreter on stdin, in place of agent.py.  The
+# agent itself follows on fd 3 as two packets: a .pyc image and the source.
+# We run the bytecode if the interpreter understands it, otherwise we fall
+# back to compiling the source.  Keep this small: it's parsed on every start.
+
+import _frozen_importlib_external
+import marshal
+import socket
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, fileno=3)
+pyc = sock.recv(1 << 16)
+source = sock.recv(1 << 16)
+sock.detach()
+
+if pyc[:4] == _frozen_importlib_external.MAGIC_NUMBER:
+    code = marshal.loads(pyc[16:])
+else:
+    code = compile(source, 'agent.py', 'exec')
+
+del pyc, source, sock
+exec(code)
@@ -20,6 +20,7 @@ import os
 import signal
 import socket
 import sys
+import time
 import urllib.parse
 
 import gi
@@ -39,37 +40,100 @@ from gi.repository import Pango
 from gi.repository import Vte
 
 from .adwaita_palette import ADWAITA_PALETTE
-from . import APP_ID, IS_FLATPAK, PKG_DIR
+from . import APP_ID, IS_FLATPAK
+from . import bootstrap
+from .snapshot import Snapshot, SnapshotWriter, list_snapshots, snapshot_dir
 
 VTE_NUMERIC_VERSION = 10000 * Vte.MAJOR_VERSION + 100 * Vte.MINOR_VERSION + Vte.MICRO_VERSION
 VTE_TERMINFO_NAME = "xterm-256color"
 VTE_ENV = {'TERM': VTE_TERMINFO_NAME, 'VTE_VERSION': f'{VTE_NUMERIC_VERSION}'}
 
+SNAPSHOT_INTERVAL = 10  # seconds
+
+STATS_INTERFACE = 'dev.boxi.Boxi.Stats'
+# The same for every instance (they have different bus names), so that we
+# don't need to repeat GApplication's escaping of the application ID
+STATS_PATH = '/dev/boxi/Boxi/Stats'
+STATS_XML = f"""
+<node>
+  <interface name="{STATS_INTERFACE}">
+    <method name="GetStats">
+      <arg type="a{{sv}}" name="agent" direction="out"/>
+      <arg type="aa{{sv}}" name="windows" direction="out"/>
+    </method>
+  </interface>
+</node>
+"""
+
 
 class Agent:
     def __init__(self, container=None):
         self.container = container
 
-        if container:
-            cmd = [sys.executable, f'{PKG_DIR}/toolbox_run.py', container, '--', '/usr/bin/python3']
-        elif IS_FLATPAK:
-            cmd = ['flatpak-spawn', '--host', '--forward-fd=3', '/usr/bin/python3']
-        else:
-            cmd = [sys.executable]
-
-        # `python3` in `ps` output isn't so helpful, so add some extra args
-        if container:
-            cmd.extend(['-', 'Boxi agent for container', container])
+        if IS_FLATPAK:
+            # Everything goes through a host agent, shared with other Boxi
+            # instances: after the first one, starting an agent costs a fork on
+            # the host instead of several trips through flatpak-spawn.
+            self.host = Agent.connect_host()
+            if container:
+                cmd = bootstrap.relayed_agent_command(container)
+                try:
+                    self.connection = bootstrap.relay_agent(self.host, cmd)
+                except OSError:
+                    # Most likely, the other instance's host agent is just
+                    # exiting: try again with our own
+                    self.host.close()
+                    self.host = Agent.start_host_agent()
+                    try:
+                        self.connection = bootstrap.relay_agent(self.host, cmd)
+                    except OSError as exc:
+                        # Do it the slow way, without a host agent
+                        print(f'Unable to start the agent via the host agent: {exc}', file=sys.stderr)
+                        self.connection = Agent.spawn(bootstrap.agent_command(container))
+            else:
+                self.connection = self.host
         else:
-            cmd.extend(['-', 'Boxi agent for host'])
+            self.connection = Agent.spawn(bootstrap.agent_command(container))
 
+    @staticmethod
+    def spawn(cmd):
         launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.NONE)
-        launcher.set_stdin_file_path(f'{PKG_DIR}/agent.py')
-        self.connection, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        launcher.set_stdin_file_path(bootstrap.LOADER_PATH)
+        connection, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
         launcher.take_fd(os.dup(theirs.fileno()), 3)
         theirs.close()
+        bootstrap.send_agent(connection)
 
         launcher.spawnv(cmd)
+        return connection
+
+    @staticmethod
+    def connect_host():
+        relay = bootstrap.connect_relay()
+        if relay is not None:
+            # The other instance's host agent might be just exiting, with
+            # our connection still in its backlog: check that it answers.
+            try:
+                bootstrap.call(relay, {'stats': True})
+                return relay
+            except OSError:
+                relay.close()
+
+        return Agent.start_host_agent()
+
+    @staticmethod
+    def start_host_agent():
+        connection = Agent.spawn(bootstrap.agent_command())
+        if bootstrap.RELAY_PATH:
+            # Without the listener, everything still works: other instances
+            # just start their own host agents.
+            try:
+                result = bootstrap.call(connection, {'listen': bootstrap.RELAY_PATH})
+            except OSError as exc:
+                result = str(exc)
+            if result is not True:
+                print(f'Unable to share the host agent at {bootstrap.RELAY_PATH}: {result}', file=sys.stderr)
+        return connection
 
     def create_session(self, listener):
         ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
@@ -78,21 +142,37 @@ class Agent:
 
         return Session(ours, listener)
 
+    def query_stats(self, callback):
+        try:
+            session = bootstrap.request(self.connection, {'stats': True})
+        except OSError:
+            callback({})
+            return
+
+        def ready(_fd, _condition, connection):
+            msg = connection.recv(10000)
+            connection.close()
+            callback(json.loads(msg) if msg else {})
+            return False
+
+        GLib.unix_fd_add_full(0, session.fileno(), GLib.IOCondition.IN, ready, session)
+
 
 class Session:
     def __init__(self, connection, listener):
         self.connection = connection
         self.listener = listener
+        self.open = True
         GLib.unix_fd_add_full(0, self.connection.fileno(), GLib.IOCondition.IN, Session.ready, self)
 
-    def start_command(self, command, cwd=None, fds=()):
-        message = {"args": command, "cwd": cwd, "env": VTE_ENV}
+    def start_command(self, command, cwd=None, fds=(), cwd_fallback=False):
+        message = {"args": command, "cwd": cwd, "env": VTE_ENV, "cwd_fallback": cwd_fallback}
         socket.send_fds(self.connection, [json.dumps(message).encode('utf-8')], fds)
         for fd in fds:
             os.close(fd)
 
-    def start_shell(self, cwd=None):
-        self.start_command([], cwd=cwd)
+    def start_shell(self, cwd=None, cwd_fallback=False):
+        self.start_command([], cwd=cwd, cwd_fallback=cwd_fallback)
 
     def open_editor(self):
         reader, writer = os.pipe()
@@ -105,6 +185,7 @@ class Session:
         if not msg:
             self.listener.session_closed()
             self.connection.close()
+            self.open = False
             del self.listener
             return False
 
@@ -114,6 +195,9 @@ class Session:
             self.listener.session_created(Vte.Pty.new_foreign_sync(fds.pop()))
         elif isinstance(message, int):
             self.listener.session_exited(message)
+        elif isinstance(message, dict) and 'error' in message:
+            # The agent has shown the error on the pty already
+            self.listener.session_exited(127)
 
         for fd in fds:
             os.close(fd)
@@ -191,26 +275,97 @@ class Terminal(Vte.Terminal):
     def set_font_name(self, value):
         self.set_font(Pango.FontDescription.from_string(value))
 
+class Paste:
+    """Pastes text into a terminal a chunk at a time, as the pty allows
+
+    Vte's own paste writes everything at once, which blocks the window (and
+    can overrun the line discipline) for very large clipboard contents.
+    """
+    CHUNK_SIZE = 4096
+
+    def __init__(self, window, text):
+        self.window = window
+        self.text = text
+        self.offset = 0
+        fd = window.terminal.get_pty().get_fd()
+        self.source = GLib.unix_fd_add_full(0, fd, GLib.IOCondition.OUT, Paste.writable, self)
+
+    @staticmethod
+    def writable(_fd, _condition, self):
+        # Vte handles bracketed paste mode and newlines for each chunk.  It
+        # queues the data and writes it when the pty allows, so we only ever
+        # add another chunk once the pty is writable again.
+        end = self.offset + Paste.CHUNK_SIZE
+        if end < len(self.text):
+            # End chunks on a line boundary, or at least never between \r and
+            # \n: Vte would turn each half into a separate \r (ie: Enter).
+            newline = self.text.rfind('\n', self.offset, end)
+            if newline != -1:
+                end = newline + 1
+            elif self.text[end - 1] == '\r':
+                end += 1
+
+        self.window.terminal.paste_text(self.text[self.offset:end])
+        self.offset = end
+
+        if self.offset < len(self.text):
+            self.window.paste_progress(self.offset / len(self.text))
+            return True
+
+        self.source = None
+        self.window.paste_finished()
+        return False
+
+    def cancel(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        self.window.paste_finished()
+
+
 class Window(Gtk.ApplicationWindow):
-    def __init__(self, application, command_line=None, path=None):
+    def __init__(self, application, command_line=None, path=None, restore=None):
         super().__init__(application=application)
         self.command_line = command_line
         self.terminal = Terminal(application)
         self.terminal.set_size(120, 48)
         self.session = application.agent.create_session(self)
-        self.set_child(self.terminal)
         self.container = None
         self.file = None
         self.path = path
         self.cwd = None
+        self.created = time.monotonic()
+
+        # Scrollback is saved up to (not including) snapshot_row.  Only
+        # shells get snapshots (see start_shell()): restoring means starting
+        # a new shell, which would be wrong for anything else.
+        self.restored = restore
+        self.snapshot_row = 0
+        self.snapshot_metadata = None
+        self.snapshot = None
+
+        # Shown while a large paste is in progress
+        self.pasting = None
+        self.paste_bar = Gtk.Box(spacing=12, halign=Gtk.Align.CENTER, valign=Gtk.Align.END,
+                                 margin_bottom=12, visible=False, css_classes=['osd', 'toolbar'])
+        self.paste_progress_bar = Gtk.ProgressBar(valign=Gtk.Align.CENTER, width_request=200)
+        self.paste_bar.append(self.paste_progress_bar)
+        cancel = Gtk.Button(label='Cancel paste')
+        cancel.connect('clicked', lambda _button: self.pasting.cancel())
+        self.paste_bar.append(cancel)
+
+        overlay = Gtk.Overlay(child=self.terminal)
+        overlay.add_overlay(self.paste_bar)
+        self.set_child(overlay)
 
         self.terminal.connect('current-directory-uri-changed', Window.terminal_update_cwd)
         self.terminal.connect('current-file-uri-changed', Window.terminal_update_cwd)
         self.terminal_update_cwd(self.terminal)
+        self.connect('close-request', Window.close_requested)
 
     @staticmethod
     def terminal_update_cwd(terminal):
-        window = terminal.get_parent()
+        window = terminal.get_root()
         cwd_uri = terminal.get_current_directory_uri()
         window.cwd = cwd_uri and urllib.parse.urlparse(cwd_uri).path
         file_uri = terminal.get_current_file_uri()
@@ -218,6 +373,12 @@ class Window(Gtk.ApplicationWindow):
         title = ['Boxi', window.get_application().container, window.path or window.file or window.cwd]
         window.set_title(' : '.join(text for text in title if text))
 
+    def start_shell(self, cwd=None, cwd_fallback=False):
+        application = self.get_application()
+        if application.snapshot_dir is not None:
+            self.snapshot = SnapshotWriter(application.snapshot_dir, path=self.restored and self.restored.path)
+        self.session.start_shell(cwd=cwd, cwd_fallback=cwd_fallback)
+
     def session_created(self, pty):
         self.terminal.set_pty(pty)
 
@@ -226,12 +387,71 @@ class Window(Gtk.ApplicationWindow):
             self.command_line.set_exit_status(returncode)
             del self.command_line
 
+    @staticmethod
+    def close_requested(self):
+        # The terminal (and its pty) goes away with us: stop writing to it
+        if self.pasting is not None:
+            self.pasting.cancel()
+        # A window that was closed on purpose shouldn't come back next time
+        if self.snapshot is not None:
+            self.snapshot.remove()
+            self.snapshot = None
+        return False
+
     def session_closed(self):
+        if self.pasting is not None:
+            self.pasting.cancel()
+        if self.snapshot is not None:
+            self.snapshot.remove()
         self.destroy()
 
+    def restore(self):
+        self.restored_tail = self.restored.tail(self.terminal.get_row_count())
+        self.terminal.feed(self.restored_tail.replace('\n', '\r\n').encode('utf-8'))
+        _col, self.snapshot_row = self.terminal.get_cursor_position()
+
+    def save_snapshot(self):
+        if self.snapshot is None or self.terminal.get_pty() is None:
+            return
+
+        # Vte doesn't tell us when the alternate screen (vim, less, ...) is in
+        # use, and we mustn't save it.  Vte numbers the rows of the normal
+        # screen from the start, and they only grow: with unlimited scrollback
+        # its first row stays 0.  The alternate screen has no scrollback, so
+        # it drops rows at the top as soon as it scrolls or gets cleared, and
+        # its rows are numbered separately, usually behind ours.  Wait until
+        # we're back on the normal screen.
+        _col, row = self.terminal.get_cursor_position()
+        if self.terminal.get_vadjustment().get_lower() > 0 or row < self.snapshot_row:
+            return
+
+        text = ''
+        if row > self.snapshot_row:
+            text, _length = self.terminal.get_text_range_format(Vte.Format.TEXT, self.snapshot_row, 0, row, 0)
+            self.snapshot_row = row
+
+        metadata = {'cwd': self.cwd, 'title': self.get_title(), 'container': self.get_application().container}
+        if text or metadata != self.snapshot_metadata:
+            self.snapshot.append(text or '', **metadata)
+            self.snapshot_metadata = metadata
+
+    def show_history(self, *_args):
+        if self.restored is None:
+            return
+
+        window = Window(self.get_application())
+        window.show()
+
+        # This is where we finally decompress the rest of the snapshot
+        history = (self.restored.history() + self.restored_tail).encode('utf-8')
+        source = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new(history))
+        stream = window.session.open_editor()
+        flags = Gio.OutputStreamSpliceFlags.CLOSE_SOURCE | Gio.OutputStreamSpliceFlags.CLOSE_TARGET
+        stream.splice_async(source, flags, GLib.PRIORITY_DEFAULT, None, lambda stream, result: stream.splice_finish(result))
+
     def new_window(self, *_args):
         window = Window(self.get_application())
-        window.session.start_shell(cwd=self.cwd or self.path and os.path.dirname(self.path))
+        window.start_shell(cwd=self.cwd or self.path and os.path.dirname(self.path))
         window.show()
 
     def edit_contents(self, *_args):
@@ -242,11 +462,40 @@ class Window(Gtk.ApplicationWindow):
         self.terminal.write_contents_sync(stream, Vte.WriteFlags.DEFAULT, None)
         stream.close()
 
+    def get_stats(self):
+        # The vertical adjustment covers the scrollback and the visible rows
+        rows = int(self.terminal.get_vadjustment().get_upper())
+        return {
+            'title': GLib.Variant('s', self.get_title() or ''),
+            'scrollback-rows': GLib.Variant('t', max(rows - self.terminal.get_row_count(), 0)),
+            'age': GLib.Variant('d', time.monotonic() - self.created),
+            'session-open': GLib.Variant('b', self.session.open),
+        }
+
     def copy(self, *_args):
         self.terminal.copy_clipboard_format(Vte.Format.TEXT)
 
     def paste(self, *_args):
-        self.terminal.paste_clipboard()
+        if self.pasting is not None or self.terminal.get_pty() is None:
+            return
+        self.get_clipboard().read_text_async(None, Window.clipboard_text_ready, self)
+
+    @staticmethod
+    def clipboard_text_ready(clipboard, result, self):
+        try:
+            text = clipboard.read_text_finish(result)
+        except GLib.Error:
+            return
+        if text and self.pasting is None and self.terminal.get_pty() is not None:
+            self.pasting = Paste(self, text)
+
+    def paste_progress(self, fraction):
+        self.paste_progress_bar.set_fraction(fraction)
+        self.paste_bar.set_visible(True)
+
+    def paste_finished(self):
+        self.pasting = None
+        self.paste_bar.set_visible(False)
 
     def zoom(self, _action, parameter, *_args):
         current = self.terminal.get_font_scale()
@@ -260,6 +509,7 @@ class Application(Gtk.Application):
 
         self.add_option('non-unique', description='Disable GApplication uniqueness')
         self.add_option('version', description='Show version')
+        self.add_option('stats', description='Show resource usage of the running instance, as JSON')
         self.add_option('container', 'c', arg=GLib.OptionArg.STRING, description='Toolbox container name')
         self.add_option('edit', description='Treat arguments as filenames to edit')
         self.add_option('', arg=GLib.OptionArg.STRING_ARRAY, arg_description='COMMAND ARGS ...')
@@ -282,6 +532,9 @@ class Application(Gtk.Application):
             self.container = None
         GLib.set_prgname(self.get_application_id())
 
+        if options.contains('stats'):
+            return self.print_stats()
+
         # Ideally, GApplication would have a flag for this, but it's a little
         # bit magic.  In case `--gapplication-service` wasn't given, we want to
         # first try to become a launcher.  If that fails then we fall back to
@@ -302,6 +555,52 @@ class Application(Gtk.Application):
 
         return -1
 
+    def print_stats(self):
+        app_id = self.get_application_id()
+        try:
+            bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            reply = bus.call_sync(app_id, STATS_PATH, STATS_INTERFACE, 'GetStats', None,
+                                  GLib.VariantType('(a{sv}aa{sv})'), Gio.DBusCallFlags.NO_AUTO_START, -1, None)
+        except GLib.Error as exc:
+            print(f'Unable to get stats from {app_id}: {exc.message}', file=sys.stderr)
+            return 1
+
+        agent, windows = reply.unpack()
+        print(json.dumps({'agent': agent, 'windows': windows}, indent=2))
+        return 0
+
+    def do_dbus_register(self, connection, object_path):
+        Gtk.Application.do_dbus_register(self, connection, object_path)
+        interface, = Gio.DBusNodeInfo.new_for_xml(STATS_XML).interfaces
+        self.stats_registration = connection.register_object(STATS_PATH, interface,
+                                                             self.stats_method_call, None, None)
+        return True
+
+    def do_dbus_unregister(self, connection, object_path):
+        connection.unregister_object(self.stats_registration)
+        Gtk.Application.do_dbus_unregister(self, connection, object_path)
+
+    def stats_method_call(self, _connection, _sender, _path, _interface, method, _params, invocation):
+        assert method == 'GetStats'
+        windows = [window.get_stats() for window in self.get_windows() if isinstance(window, Window)]
+
+        def reply(agent_stats):
+            agent = {
+                'container': GLib.Variant('s', self.container or ''),
+                'open-sessions': GLib.Variant('u', sum(window['session-open'].unpack() for window in windows)),
+            }
+            for key in ('pid', 'threads', 'sessions'):
+                if key in agent_stats:
+                    agent[key] = GLib.Variant('u', agent_stats[key])
+            if 'rss' in agent_stats:
+                agent['rss'] = GLib.Variant('t', agent_stats['rss'])
+            invocation.return_value(GLib.Variant('(a{sv}aa{sv})', (agent, windows)))
+
+        if hasattr(self, 'agent'):
+            self.agent.query_stats(reply)
+        else:
+            reply({})
+
     def do_startup(self):
         Gtk.Application.do_startup(self)
 
@@ -318,6 +617,7 @@ class Application(Gtk.Application):
         Window.install_action('win.copy', None, Window.copy)
         Window.install_action('win.paste', None, Window.paste)
         Window.install_action('win.zoom', 's', Window.zoom)
+        Window.install_action('win.show-history', None, Window.show_history)
 
         self.set_accels_for_action("win.new-window", ["<Ctrl><Shift>N"])
         self.set_accels_for_action("win.edit-contents", ["<Ctrl><Shift>S"])
@@ -326,8 +626,46 @@ class Application(Gtk.Application):
         self.set_accels_for_action("win.zoom::default", ["<Ctrl>0"])
         self.set_accels_for_action("win.zoom::in", ["<Ctrl>equal", "<Ctrl>plus"])
         self.set_accels_for_action("win.zoom::out", ["<Ctrl>minus"])
+        self.set_accels_for_action("win.show-history", ["<Ctrl><Shift>H"])
+
+        # A non-unique instance would fight with the primary one over the files
+        non_unique = self.get_flags() & Gio.ApplicationFlags.NON_UNIQUE
+        if self.boxi_settings.get_boolean('restore-sessions') and not non_unique:
+            self.snapshot_dir = snapshot_dir(self.get_application_id())
+            GLib.timeout_add_seconds(SNAPSHOT_INTERVAL, self.save_snapshots)
+        else:
+            self.snapshot_dir = None
 
         self.agent = Agent(self.container)
+        self.restore_sessions()
+
+    def save_snapshots(self):
+        for window in self.get_windows():
+            if isinstance(window, Window):
+                window.save_snapshot()
+        return True
+
+    def restore_sessions(self):
+        if self.snapshot_dir is None:
+            return
+
+        # Any snapshots at this point are from an instance that didn't exit cleanly
+        for path in list_snapshots(self.snapshot_dir):
+            try:
+                previous = Snapshot(path)
+            except OSError:
+                continue
+
+            if previous.metadata is None:
+                SnapshotWriter(path=path).remove()
+                continue
+
+            window = Window(self, restore=previous)
+            window.restore()
+            # The directory might be gone by now: the agent checks, since
+            # it's in the same place as the shell (host or container)
+            window.start_shell(cwd=previous.metadata['cwd'], cwd_fallback=True)
+            window.show()
 
     def do_command_line(self, command_line):
         options = command_line.get_options_dict()
@@ -346,7 +684,7 @@ class Application(Gtk.Application):
             if args:
                 window.session.start_command(args.get_strv())
             else:
-                window.session.start_shell()
+                window.start_shell()
             window.show()
 
             return -1  # real return value comes later
@@ -369,7 +707,7 @@ class Application(Gtk.Application):
 
     def do_activate(self):
         window = Window(self)
-        window.session.start_shell()
+        window.start_shell()
         window.show()
 
 
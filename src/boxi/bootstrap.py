@@ -0,0 +1,179 @@
+# Boxi - Terminal emulator for use with Toolbox
+#
+# Copyright (C) 2022 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib.util
+import json
+import marshal
+import os
+import socket
+import subprocess
+import sys
+
+from . import APP_ID, IS_FLATPAK, PKG_DIR
+
+AGENT_PATH = f'{PKG_DIR}/agent.py'
+LOADER_PATH = f'{PKG_DIR}/agent_loader.py'
+
+# In Flatpak, the host agent listens here so that other Boxi instances can use
+# it too.  $XDG_RUNTIME_DIR/app/$FLATPAK_ID is the same path on both sides.
+RELAY_PATH = IS_FLATPAK and os.environ.get('XDG_RUNTIME_DIR') and \
+    f"{os.environ['XDG_RUNTIME_DIR']}/app/{APP_ID}/host-agent"
+
+# How long we wait for an agent to answer a request which it handles itself,
+# without running anything.  We do that during startup, on the main thread.
+REPLY_TIMEOUT = 2
+
+_packets = None
+
+
+def agent_packets():
+    global _packets
+
+    if _packets is None:
+        with open(AGENT_PATH, 'rb') as file:
+            source = file.read()
+        code = compile(source, 'agent.py', 'exec')
+        # The same layout as a .pyc file: magic, flags, and 8 unused bytes
+        pyc = importlib.util.MAGIC_NUMBER + bytes(12) + marshal.dumps(code)
+        _packets = pyc, source
+
+    return _packets
+
+
+def agent_command(container=None):
+    if container:
+        cmd = [sys.executable, f'{PKG_DIR}/toolbox_run.py', container, '--', '/usr/bin/python3']
+    elif IS_FLATPAK:
+        cmd = ['flatpak-spawn', '--host', '--forward-fd=3', '/usr/bin/python3']
+    else:
+        cmd = [sys.executable]
+
+    # `python3` in `ps` output isn't so helpful, so add some extra args
+    if container:
+        cmd.extend(['-', 'Boxi agent for container', container])
+    else:
+        cmd.extend(['-', 'Boxi agent for host'])
+
+    return cmd
+
+
+def relayed_agent_command(container):
+    """The command for a host agent to start an agent in a container
+
+    This is toolbox_run.py, but from the host's Python, which doesn't have boxi.
+    """
+    with open(f'{PKG_DIR}/toolbox_run.py', encoding='utf-8') as file:
+        toolbox_run = file.read()
+
+    return ['/usr/bin/python3', '-c', toolbox_run, container, '--',
+            '/usr/bin/python3', '-', 'Boxi agent for container', container]
+
+
+def send_agent(sock):
+    """Queues the agent for agent_loader.py on the host end of its fd 3"""
+    for packet in agent_packets():
+        sock.send(packet)
+
+
+def spawn_agent(cmd):
+    """Starts an agent without GLib, the same way app.Agent does
+
+    Returns the connection to the agent and the Popen for cmd.  The agent
+    daemonizes itself, so that usually exits quickly.
+    """
+    connection, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    send_agent(connection)
+
+    def setup_fd3(fd=theirs.fileno()):
+        if fd == 3:
+            os.set_inheritable(fd, True)
+        else:
+            os.dup2(fd, 3)
+
+    with open(LOADER_PATH, 'rb') as loader:
+        process = subprocess.Popen(cmd, stdin=loader, close_fds=False, preexec_fn=setup_fd3)
+    theirs.close()
+
+    return connection, process
+
+
+def connect_relay():
+    """Connects to the host agent of another Boxi instance, if there is one"""
+    if not RELAY_PATH:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.connect(RELAY_PATH)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def request(connection, message, fds=()):
+    """Sends a single request to the agent on a new session"""
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        socket.send_fds(connection, [b' '], [theirs.fileno()])
+    finally:
+        theirs.close()
+
+    try:
+        socket.send_fds(ours, [json.dumps(message).encode('utf-8')], fds)
+    except OSError:
+        ours.close()
+        raise
+    return ours
+
+
+def call(connection, message):
+    """Sends a single request to the agent and returns its reply
+
+    Raises OSError if the agent isn't there anymore, or TimeoutError (which
+    is an OSError too) if it doesn't reply within REPLY_TIMEOUT.
+    """
+    with request(connection, message) as session:
+        session.settimeout(REPLY_TIMEOUT)
+        msg = session.recv(10000)
+    if not msg:
+        raise ConnectionError('agent closed the session without replying')
+    return json.loads(msg)
+
+
+def relay_agent(connection, cmd):
+    """Asks the agent on connection to start the agent cmd
+
+    Returns our connection to the new agent.  Raises OSError if the agent
+    on connection isn't there anymore, or doesn't reply in time.
+    """
+    with open(LOADER_PATH, 'rb') as loader:
+        message = {'args': cmd, 'cwd': os.getcwd(), 'env': {}, 'pty': False, 'agent': True}
+        session = request(connection, message, [loader.fileno()])
+
+    with session:
+        session.settimeout(REPLY_TIMEOUT)
+        msg, fds, _flags, _addr = socket.recv_fds(session, 10000, 1)
+        if not msg or json.loads(msg) != 'agent' or len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError('agent failed to start another agent')
+
+    agent = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, fileno=fds[0])
+    send_agent(agent)
+    return agent
@@ -0,0 +1,225 @@
+# Boxi - Terminal emulator for use with Toolbox
+#
+# Copyright (C) 2022 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run commands through a Boxi agent, without GTK
+
+    with boxi.client.Agent('f39') as agent:
+        process = agent.spawn(['make'], cwd='/src', stdout=fd)
+        returncode = process.wait()
+
+Each command gets its own session on the agent's connection, so any number
+of them can run at the same time, from threads or with asyncio (see
+Agent.spawn_async() and Process.wait_async()).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from . import bootstrap
+
+
+class Process:
+    """A command running in an agent session
+
+    If the session was created with pty=True, then .pty is the pty master.
+    It belongs to the Process, and is closed by close().
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.pty = None
+        self.returncode = None
+
+    def _receive(self):
+        msg, fds, _flags, _addr = socket.recv_fds(self.connection, 10000, 1)
+        if not msg:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError('agent closed the session without an exit status')
+
+        message = json.loads(msg)
+        if message == 'pty' and fds:
+            self.pty = fds.pop(0)
+        for fd in fds:
+            os.close(fd)
+
+        if isinstance(message, int):
+            self.returncode = message
+            self.connection.close()
+        elif isinstance(message, dict) and 'error' in message:
+            # the command couldn't be started at all
+            self.connection.close()
+            raise OSError(message['error'], message.get('message'))
+
+    async def _receive_async(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.connection, readable.set_result, None)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.connection)
+        self._receive()
+
+    def wait(self):
+        """Waits for the exit status, raising OSError if the command couldn't start"""
+        while self.returncode is None:
+            self._receive()
+        return self.returncode
+
+    async def wait_async(self):
+        while self.returncode is None:
+            await self._receive_async()
+        return self.returncode
+
+    def close(self):
+        if self.pty is not None:
+            os.close(self.pty)
+            self.pty = None
+        self.connection.close()
+
+
+class Agent:
+    """A connection to an agent, on the host or in a toolbox container"""
+    def __init__(self, container=None):
+        self.connection, process = bootstrap.spawn_agent(bootstrap.agent_command(container))
+        process.wait()
+
+    def _start(self, args, cwd, env, stdin, stdout, stderr, pty):
+        stdio = {0: stdin, 1: stdout, 2: stderr}
+        stdio = {n: fd for n, fd in stdio.items() if fd is not None}
+        message = {'args': args, 'cwd': cwd, 'env': env or {}, 'stdio': list(stdio), 'pty': pty}
+        return Process(bootstrap.request(self.connection, message, list(stdio.values())))
+
+    def spawn(self, args, cwd=None, env=None, stdin=None, stdout=None, stderr=None, pty=False, timeout=None):
+        """Starts args in a new session
+
+        stdin, stdout and stderr are fds to pass to the command: they remain
+        open in the caller.  The others are connected to a new pty if pty is
+        True, and to /dev/null otherwise.  env is added to the agent's own
+        environment.  With pty=True, this waits until the pty is available.
+        With a timeout, any wait for the agent (here, or in wait()) raises
+        TimeoutError after that many seconds.
+        """
+        process = self._start(args, cwd, env, stdin, stdout, stderr, pty)
+        process.connection.settimeout(timeout)
+        try:
+            while pty and process.pty is None and process.returncode is None:
+                process._receive()
+        except BaseException:
+            process.close()
+            raise
+        return process
+
+    async def spawn_async(self, args, cwd=None, env=None, stdin=None, stdout=None, stderr=None, pty=False):
+        """Like spawn(), but waits for the pty without blocking the loop"""
+        process = self._start(args, cwd, env, stdin, stdout, stderr, pty)
+        try:
+            while pty and process.pty is None and process.returncode is None:
+                await process._receive_async()
+        except BaseException:
+            process.close()
+            raise
+        return process
+
+    def run(self, args, **kwargs):
+        """Runs args to completion, returning the exit status"""
+        process = self.spawn(args, **kwargs)
+        try:
+            return process.wait()
+        finally:
+            process.close()
+
+    async def run_async(self, args, **kwargs):
+        process = await self.spawn_async(args, **kwargs)
+        try:
+            return await process.wait_async()
+        finally:
+            process.close()
+
+    def stats(self):
+        """Returns the agent's pid, rss (in bytes), and thread and session counts"""
+        return bootstrap.call(self.connection, {'stats': True})
+
+    def close(self):
+        # The agent exits when it sees this
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+
+def benchmark(container, args, count):
+    if container:
+        baseline = ['toolbox', 'run', '--container', container, *args]
+    else:
+        baseline = args
+
+    start = time.monotonic()
+    for _ in range(count):
+        subprocess.run(baseline, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=False)
+    print(f'{" ".join(baseline)}: {(time.monotonic() - start) / count * 1000:.2f}ms per command')
+
+    start = time.monotonic()
+    with Agent(container) as agent:
+        started = time.monotonic()
+        for _ in range(count):
+            agent.run(args)
+        print(f'agent, sequential: {(time.monotonic() - started) / count * 1000:.2f}ms per command '
+              f'(+{(started - start) * 1000:.0f}ms to start the agent)')
+
+        async def run_all():
+            await asyncio.gather(*(agent.run_async(args) for _ in range(count)))
+
+        start = time.monotonic()
+        asyncio.run(run_all())
+        print(f'agent, concurrent: {(time.monotonic() - start) / count * 1000:.2f}ms per command')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a command through a Boxi agent")
+    parser.add_argument('--container', '-c', help="Toolbox container name [default: the host]")
+    parser.add_argument('--benchmark', type=int, metavar='N',
+                        help="Run the command N times, comparing with `toolbox run`")
+    parser.add_argument('cmd', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.cmd[:1] == ['--']:
+        del args.cmd[0]
+    if not args.cmd:
+        parser.error('the following arguments are required: cmd')
+
+    if args.benchmark:
+        benchmark(args.container, args.cmd, args.benchmark)
+    else:
+        with Agent(args.container) as agent:
+            try:
+                returncode = agent.run(args.cmd, cwd=os.getcwd(), stdin=0, stdout=1, stderr=2)
+            except OSError as exc:
+                sys.exit(f'{parser.prog}: {exc.strerror}')
+        sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
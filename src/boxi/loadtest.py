@@ -0,0 +1,226 @@
+# Boxi - Terminal emulator for use with Toolbox
+#
+# Copyright (C) 2022 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load test for the agent protocol, without GTK
+
+This starts agent.py on the host, just like app.Agent does, and runs many
+short sessions through it in parallel: `python3 -m boxi.loadtest`.  It
+reports handshake and exit notification latencies, and checks that neither
+the agent nor we leak file descriptors or threads.  With --hold, it instead
+keeps that many sessions (running `cat`) alive at the same time, and then
+ends them all at once, like closing a window with many tabs.  Exits with
+status 1 if something went wrong, including a session which doesn't get a
+reply within --timeout, so it can run in CI.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import statistics
+import sys
+import threading
+import time
+
+from .client import Agent
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def count_fds(pid):
+    return len(os.listdir(f'/proc/{pid}/fd'))
+
+
+def count_threads(pid):
+    with open(f'/proc/{pid}/status', encoding='ascii') as status:
+        for line in status:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    return 0
+
+
+def session(agent, args, timeout):
+    """Runs one session, returning (handshake, exit latency)
+
+    The handshake is the time from requesting the session until we have the
+    pty, and the exit latency is from there until the exit status.
+    """
+    start = time.monotonic()
+    process = agent.spawn(args, pty=True, timeout=timeout)
+    handshake = time.monotonic()
+    try:
+        returncode = process.wait()
+        exited = time.monotonic()
+    finally:
+        process.close()
+
+    assert returncode == 0, returncode
+    return handshake - start, exited - handshake
+
+
+def held_session(agent, timeout):
+    """Starts `cat` in a session, returning (process, handshake)"""
+    start = time.monotonic()
+    process = agent.spawn(['cat'], pty=True, timeout=timeout)
+    return process, time.monotonic() - start
+
+
+def release(process, released):
+    """Waits for a held session after its EOF, returning the exit latency"""
+    try:
+        returncode = process.wait()
+        exited = time.monotonic()
+    finally:
+        process.close()
+
+    assert returncode == 0, returncode
+    return exited - released
+
+
+class ThreadSampler(threading.Thread):
+    """Keeps track of the most threads the agent had, while the test runs"""
+    INTERVAL = 0.005
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.max_threads = 0
+        self.done = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.max_threads = max(self.max_threads, count_threads(self.pid))
+            except OSError:
+                break  # the agent is gone
+            if self.done.wait(self.INTERVAL):
+                break
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        return self.max_threads
+
+
+def results(futures):
+    """Collects the results of the futures, returning (results, failures)"""
+    values = []
+    failures = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            values.append(future.result())
+        except (OSError, AssertionError) as exc:
+            # includes TimeoutError, if the agent didn't reply in time
+            print(f'session failed: {exc!r}', file=sys.stderr)
+            failures += 1
+    return values, failures
+
+
+def agent_pid(agent):
+    # The agent forks away from the process we started, but it is the parent
+    # of everything it runs.
+    reader, writer = os.pipe()
+    with open(reader, 'rb') as output:
+        agent.run(['sh', '-c', 'echo $PPID'], stdout=writer)
+        os.close(writer)
+        return int(output.read())
+
+
+def report(name, values):
+    values_ms = [value * 1000 for value in values]
+    print(f'{name:>10}: p50 {statistics.median(values_ms):.2f}ms, '
+          f'p99 {percentile(values_ms, 0.99):.2f}ms, max {max(values_ms):.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the Boxi agent")
+    parser.add_argument('--sessions', type=int, default=2000, help="Total number of sessions [default: 2000]")
+    parser.add_argument('--parallel', type=int, default=200, help="Sessions in flight at once [default: 200]")
+    parser.add_argument('--command', default='true', help="Command to run in each session [default: 'true']")
+    parser.add_argument('--hold', type=int, metavar='N',
+                        help="Keep N sessions alive at once, then end them together, instead of --sessions")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="Seconds to wait for each reply from the agent before failing [default: 10]")
+    args = parser.parse_args()
+
+    our_fds = count_fds('self')
+    agent = Agent()
+    pid = agent_pid(agent)
+    agent_fds = count_fds(pid)
+
+    sampler = ThreadSampler(pid)
+    sampler.start()
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(args.parallel) as executor:
+        if args.hold:
+            futures = [executor.submit(held_session, agent, args.timeout) for _ in range(args.hold)]
+            held, failures = results(futures)
+            processes = [process for process, _handshake in held]
+            handshakes = [handshake for _process, handshake in held]
+            count = len(processes)
+            print(f'holding {count} sessions: {count_threads(pid)} agent threads, {count_fds(pid)} agent fds')
+
+            # ^D at the start of a line: each cat sees EOF and exits
+            released = time.monotonic()
+            for process in processes:
+                os.write(process.pty, b'\x04')
+            futures = [executor.submit(release, process, released) for process in processes]
+            exits, release_failures = results(futures)
+            failures += release_failures
+        else:
+            futures = [executor.submit(session, agent, args.command.split(), args.timeout)
+                       for _ in range(args.sessions)]
+            latencies, failures = results(futures)
+            handshakes = [handshake for handshake, _exit in latencies]
+            exits = [exit_latency for _handshake, exit_latency in latencies]
+            count = args.sessions
+    elapsed = time.monotonic() - start
+    max_threads = sampler.stop()
+
+    # Session threads finish just after sending the exit status: give them a moment
+    deadline = time.monotonic() + 5
+    while count_threads(pid) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    leaked_agent_fds = count_fds(pid) - agent_fds
+    final_threads = count_threads(pid)
+    agent.close()
+    leaked_fds = count_fds('self') - our_fds
+
+    if args.hold:
+        print(f'{count} sessions held at once, {elapsed:.2f}s')
+    else:
+        print(f'{count} sessions, {args.parallel} in parallel, {elapsed:.2f}s '
+              f'({count / elapsed:.0f} sessions/s)')
+    if handshakes:
+        report('handshake', handshakes)
+    if exits:
+        report('exit', exits)
+    print(f'agent threads: {max_threads} max, {final_threads} at the end')
+    print(f'leaked fds: {leaked_agent_fds} in the agent, {leaked_fds} in the client')
+    if failures:
+        print(f'failed sessions: {failures}')
+
+    if failures or leaked_agent_fds or leaked_fds or final_threads != 1:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,22 +17,129 @@
 
 import argparse
 import asyncio
+import glob
 import json
 import logging
 import os
+import re
 import textwrap
 
+from typing import NamedTuple, Optional
+
 logger = logging.getLogger('boxi.monitor')
 
 
+class LabelRule(NamedTuple):
+    """A family of containers, selected by label, and how to present them"""
+    label: str
+    value: Optional[str]  # None matches any value
+    name: str             # template for the launcher's Name=, with {container} and {image}
+    # template for the launcher's Exec=, with {execbase} and {container}.  The
+    # default goes through toolbox, so other containers need their own.
+    command: str = '{execbase} -c {container}'
+
+    @staticmethod
+    def parse(text):
+        """Parses 'LABEL[=VALUE]:NAME[:EXEC]', as given on the commandline"""
+        selector, sep, rest = text.partition(':')
+        name, sep2, command = rest.partition(':')
+        label, eq, value = selector.partition('=')
+        if not sep or not label or not name or (sep2 and not command):
+            raise ValueError(f"invalid rule '{text}': expected LABEL[=VALUE]:NAME[:EXEC]")
+
+        # Catch typos in the templates now, rather than on the first install()
+        for template, keys in ((name, ('container', 'image')), (command, ('execbase', 'container'))):
+            try:
+                template.format(**{key: '' for key in keys})
+            except (KeyError, IndexError, ValueError) as exc:
+                raise ValueError(f"invalid rule '{text}': bad template '{template}' ({exc!r})") from exc
+
+        if command:
+            return LabelRule(label, value if eq else None, name, command)
+        return LabelRule(label, value if eq else None, name)
+
+
+TOOLBOX_RULE = LabelRule('com.github.containers.toolbox', 'true', '{container} Toolbox (Boxi)')
+
+
+class ImageInfo(NamedTuple):
+    distro: Optional[str]  # like os-release's ID, if we know it
+    name: str              # for display, like 'Fedora 39'
+
+
+DISTROS = {
+    'arch': 'Arch Linux',
+    'centos': 'CentOS Stream',
+    'debian': 'Debian',
+    'fedora': 'Fedora',
+    'opensuse': 'openSUSE',
+    'rhel': 'Red Hat Enterprise Linux',
+    'ubi': 'Red Hat Enterprise Linux',
+    'ubuntu': 'Ubuntu',
+}
+
+
+def printable(text):
+    # Labels end up in desktop files: a newline there would start a new key
+    return re.sub('[\x00-\x1f\x7f]+', ' ', text).strip()
+
+
+def image_info(image_name, labels):
+    # We can't read the image's os-release without mounting it, but toolbx
+    # images label themselves like name=fedora-toolbox, version=39, and the
+    # image name is usually similar (registry.fedoraproject.org/fedora-toolbox:39).
+    repository, _, tag = image_name.rpartition('/')[2].partition(':')
+    for candidate in (labels.get('name', ''), repository):
+        for word in re.split('[^a-z]+', candidate.lower()):
+            if word in DISTROS:
+                version = labels.get('version') or tag
+                distro = 'rhel' if word == 'ubi' else word
+                return ImageInfo(distro, printable(f'{DISTROS[word]} {version}'))
+
+    return ImageInfo(None, printable(image_name.rpartition('/')[2]) or 'Unknown image')
+
+
+def icon_dirs():
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    data_dirs = os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share'
+    return [f'{data_home}/icons', *(f'{d}/icons' for d in data_dirs.split(':') if d), '/usr/share/pixmaps']
+
+
+def have_icon(name):
+    """Checks if any icon theme has an icon with this name, in any size"""
+    name = glob.escape(name)
+    for directory in map(glob.escape, icon_dirs()):
+        # either unthemed, or like hicolor/scalable/apps/
+        if glob.glob(f'{directory}/{name}.*') or glob.glob(f'{directory}/*/*/*/{name}.*'):
+            return True
+    return False
+
+
 class ContainerTracker:
-    def __init__(self, filters=(), podman=None):
-        self.filters = [f'--filter={item}' for item in filters]
-        self.podman = podman or 'podman'
+    BATCH_DELAY = 0.2
 
-        self.containers = set()
+    def __init__(self, rules=(TOOLBOX_RULE,), podman=None):
+        self.podman = podman or 'podman'
 
-    def update(self):
+        # We subscribe to all container events and match the labels here,
+        # instead of asking podman to filter.  That way, a single pair of
+        # podman processes can serve any number of container families.  The
+        # index lets us look at only the labels that some rule cares about.
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.label, []).append(rule)
+
+        self.containers = {}  # name → matching LabelRule
+        self.image_names = {}  # name → image name, like 'registry.fedoraproject.org/fedora-toolbox:39'
+
+    def match(self, labels):
+        for label in self.rules.keys() & labels.keys():
+            for rule in self.rules[label]:
+                if rule.value is None or rule.value == labels[label]:
+                    return rule
+        return None
+
+    async def update(self):
         raise NotImplementedError
 
     async def run(self):
@@ -48,7 +155,6 @@ class ContainerTracker:
             '--format=json',
             '--since=10s',
             '--filter=type=container',
-            *self.filters,
             stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE)
 
         # Collect the initial list of containers
@@ -58,21 +164,40 @@ class ContainerTracker:
             'list',
             '--format=json',
             '--all',
-            *self.filters,
             stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE)
 
         stdout, _stderr = await container_list.communicate()
         for container in json.loads(stdout):
             try:
-                self.containers.update(container['Names'])
+                rule = self.match(container.get('Labels') or {})
+                if rule is not None:
+                    for name in container['Names']:
+                        self.containers[name] = rule
+                        if container.get('Image'):
+                            self.image_names[name] = container['Image']
             except KeyError:
                 pass
 
         # Initial state synchronisation
-        self.update()
+        await self.update()
+
+        # Process the event queue.  Events tend to come in bursts, so once
+        # something has changed, we keep collecting changes for BATCH_DELAY
+        # and then call update() once for the entire batch.
+        loop = asyncio.get_running_loop()
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                line = await asyncio.wait_for(events.stdout.readline(), timeout)
+            except asyncio.TimeoutError:
+                await self.update()
+                deadline = None
+                continue
+
+            if not line:
+                break
 
-        # Process the event queue
-        while line := await events.stdout.readline():
             message = json.loads(line)
             try:
                 object_type = message['Type']
@@ -81,24 +206,36 @@ class ContainerTracker:
             except KeyError:
                 continue
 
-            length_before = len(self.containers)
+            changed = False
 
             if object_type == 'container' and name:
                 if status == 'create':
-                    self.containers.add(name)
+                    # event attributes are the container's labels, plus a few
+                    # extra keys like 'image' and 'name' which won't match
+                    attributes = message.get('Attributes') or {}
+                    rule = self.match(attributes)
+                    if rule is not None and name not in self.containers:
+                        self.containers[name] = rule
+                        image = message.get('Image') or attributes.get('image')
+                        if image:
+                            self.image_names[name] = image
+                        changed = True
                 elif status == 'remove':
-                    self.containers.remove(name)
+                    changed = self.containers.pop(name, None) is not None
+                    self.image_names.pop(name, None)
 
-            # Any possible change above changes the length
-            if len(self.containers) != length_before:
-                self.update()
+            if changed and deadline is None:
+                deadline = loop.time() + self.BATCH_DELAY
+
+        if deadline is not None:
+            await self.update()
 
         await events.wait()
 
 
 class BoxiDesktopFileManager(ContainerTracker):
     def __init__(self, flatpak=False, appid=None, execbase=None, **kwargs):
-        super().__init__(filters=['label=com.github.containers.toolbox=true'], **kwargs)
+        super().__init__(**kwargs)
 
         self.appid = appid or 'dev.boxi.Boxi'
         self.execbase = execbase or (f'flatpak run {self.appid}' if flatpak else 'boxi')
@@ -108,6 +245,8 @@ class BoxiDesktopFileManager(ContainerTracker):
         self.public_dir = f'{xdg_data_home}/applications'
 
         self.have_files = set()
+        self.images = {}  # image name → ImageInfo
+        self.icons = {}   # distro → icon name
 
         os.makedirs(self.private_dir, exist_ok=True)
         for entry in os.scandir(self.private_dir):
@@ -116,19 +255,68 @@ class BoxiDesktopFileManager(ContainerTracker):
                 if len(slices) == 3 and slices[0] == self.appid and slices[2] == 'desktop':
                     self.have_files.add(slices[1])
 
-    def install(self, container):
-        if container.startswith('f'):
-            icon = f'{self.appid}.fedora'
-        else:
-            icon = self.appid
+    async def inspect(self, containers):
+        """Finds the ImageInfo for each of the given containers
+
+        This is done with a single `podman container inspect` for all of them:
+        containers inherit the labels of their image, so we get everything we
+        need in one go.  The results are cached by image name, which both the
+        initial list and the events tell us, so containers from an image that
+        we've seen before don't need podman at all.
+        """
+        result = {}
+        for container in containers:
+            image_name = self.image_names.get(container)
+            if image_name in self.images:
+                result[container] = self.images[image_name]
+
+        containers = [container for container in containers if container not in result]
+        if not containers:
+            return result
+
+        inspect = await asyncio.create_subprocess_exec(
+            self.podman,
+            'container',
+            'inspect',
+            '--format=json',
+            *containers,
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE)
+
+        # This fails for containers which have gone away in the meantime, but
+        # we still get the results for the others.
+        stdout, _stderr = await inspect.communicate()
+
+        for container in json.loads(stdout or '[]'):
+            try:
+                image_name = container['ImageName']
+                if image_name not in self.images:
+                    labels = container['Config'].get('Labels') or {}
+                    self.images[image_name] = image_info(image_name, labels)
+                result[container['Name']] = self.images[image_name]
+            except KeyError:
+                pass
+
+        return result
+
+    def icon(self, distro):
+        # Our own per-distro icon if someone installed one, otherwise the
+        # distro's logo from the icon theme (see README), otherwise ours
+        if distro not in self.icons:
+            candidates = [f'{self.appid}.{distro}', f'distributor-logo-{distro}', distro] if distro else []
+            self.icons[distro] = next((name for name in candidates if have_icon(name)), self.appid)
+        return self.icons[distro]
+
+    def install(self, container, rule, image):
+        icon = self.icon(image.distro)
 
         contents = f"""
             [Desktop Entry]
             Type=Application
-            Name={container} Toolbox (Boxi)
+            Name={rule.name.format(container=container, image=image.name)}
+            Comment={image.name}
             Icon={icon}
             StartupNotify=true
-            Exec={self.execbase} -c {container}
+            Exec={rule.command.format(execbase=self.execbase, container=container)}
         """
 
         basename = f'{self.appid}.{container}.desktop'
@@ -168,16 +356,19 @@ class BoxiDesktopFileManager(ContainerTracker):
 
         self.have_files.remove(container)
 
-    def update(self):
+    async def update(self):
         logger.debug('list of files is now %s', self.have_files)
         logger.debug('list of containers is now %s', self.containers)
 
-        to_install = self.containers - self.have_files
-        to_remove = self.have_files - self.containers
+        to_install = self.containers.keys() - self.have_files
+        to_remove = self.have_files - self.containers.keys()
+
+        images = await self.inspect(to_install) if to_install else {}
+        unknown = ImageInfo(None, 'Unknown image')
 
         for container in to_install:
             logger.debug('install %s', container)
-            self.install(container)
+            self.install(container, self.containers[container], images.get(container, unknown))
 
         for container in to_remove:
             logger.debug('uninstall %s', container)
@@ -190,9 +381,15 @@ def main():
     parser.add_argument('--appid', required=False, help="Application ID [default: 'dev.boxi.Boxi']")
     parser.add_argument('--exec', required=False, help="The prefix for the Exec= line in created desktop files")
     parser.add_argument('--podman', required=False, help="Path to podman [default: 'podman']")
+    parser.add_argument('--rule', action='append', type=LabelRule.parse, metavar='LABEL[=VALUE]:NAME[:EXEC]',
+                        help="Create launchers for containers with this label, named from this template "
+                             "with {container} and {image} [default: 'com.github.containers.toolbox=true:{container} Toolbox (Boxi)'].  "
+                             "EXEC is the command, with {execbase} and {container} [default: '{execbase} -c {container}', "
+                             "which only works for toolbox containers]")
     args = parser.parse_args()
 
-    manager = BoxiDesktopFileManager(flatpak=args.flatpak, appid=args.appid, execbase=args.exec, podman=args.podman)
+    manager = BoxiDesktopFileManager(flatpak=args.flatpak, appid=args.appid, execbase=args.exec, podman=args.podman,
+                                     rules=args.rule or (TOOLBOX_RULE,))
     asyncio.run(manager.run())
 
 
@@ -0,0 +1,135 @@
+# Boxi - Terminal emulator for use with Toolbox
+#
+# Copyright (C) 2022 Allison Karlitskaya <allison.karlitskaya@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Session snapshots, for restoring scrollback after a restart
+
+A snapshot file is a sequence of independently compressed frames, each
+preceded by its length.  Every frame is a JSON object with the window's
+metadata at the time (cwd, title, container) and the rows of text that
+were added to the scrollback since the previous frame.  Frames are only
+ever appended, and a partly written frame at the end (after a crash) is
+ignored.  Since the metadata is repeated in every frame, and frames can be
+located without decompressing them, the most recent part of a session can
+be restored without reading the rest of the file.
+"""
+
+import concurrent.futures
+import json
+import os
+import struct
+import uuid
+import zlib
+
+FRAME_HEADER = struct.Struct('>I')
+
+_executor = None
+
+
+def snapshot_dir(application_id):
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    return f'{state_home}/boxi/sessions/{application_id}'
+
+
+def list_snapshots(directory):
+    try:
+        return sorted(entry.path for entry in os.scandir(directory) if entry.name.endswith('.snapshot'))
+    except FileNotFoundError:
+        return []
+
+
+class SnapshotWriter:
+    """Appends frames to a snapshot file from a background thread"""
+    def __init__(self, directory=None, path=None):
+        self.path = path or f'{directory}/{uuid.uuid4()}.snapshot'
+
+    @staticmethod
+    def submit(function, *args):
+        global _executor
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='boxi-snapshot')
+        return _executor.submit(function, *args)
+
+    def append(self, text, **metadata):
+        return SnapshotWriter.submit(self.write_frame, dict(metadata, text=text))
+
+    def remove(self):
+        return SnapshotWriter.submit(self.unlink)
+
+    def write_frame(self, record):
+        # Level 1 is about twice as fast as the default, for most of the ratio
+        frame = zlib.compress(json.dumps(record).encode('utf-8'), 1)
+        # Scrollback can contain anything: keep it private to the user
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(self.path, os.O_APPEND | os.O_CREAT | os.O_WRONLY, 0o600)
+        with open(fd, 'ab') as file:
+            file.write(FRAME_HEADER.pack(len(frame)) + frame)
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Snapshot:
+    """A snapshot file from an earlier session, read lazily from the end"""
+    def __init__(self, path):
+        self.path = path
+        self.frames = []  # (offset, length)
+
+        # Only the headers get read here
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            offset = 0
+            while offset + FRAME_HEADER.size <= size:
+                file.seek(offset)
+                length, = FRAME_HEADER.unpack(file.read(FRAME_HEADER.size))
+                if offset + FRAME_HEADER.size + length > size:
+                    break
+                self.frames.append((offset + FRAME_HEADER.size, length))
+                offset += FRAME_HEADER.size + length
+
+        # The frames (from the start) and text that tail() hasn't returned
+        self.pending = len(self.frames)
+        self.leftover = ''
+        try:
+            self.metadata = self.read_frame(self.frames[-1])
+            del self.metadata['text']
+        except (IndexError, KeyError, ValueError, zlib.error):
+            self.metadata = None  # nothing useful in there
+
+    def read_frame(self, frame):
+        offset, length = frame
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            return json.loads(zlib.decompress(file.read(length)))
+
+    def tail(self, rows):
+        """Returns the last rows lines of text, reading as few frames as possible"""
+        text = ''
+        while self.pending and text.count('\n') <= rows:
+            self.pending -= 1
+            text = self.read_frame(self.frames[self.pending])['text'] + text
+
+        lines = text.splitlines(keepends=True)
+        cut = max(len(lines) - rows, 0)
+        self.leftover = ''.join(lines[:cut])
+        return ''.join(lines[cut:])
+
+    def history(self):
+        """Returns the text before tail(), decompressing it only now"""
+        return ''.join(self.read_frame(frame)['text'] for frame in self.frames[:self.pending]) + self.leftover